@@ -4,26 +4,97 @@ This is the API used to connect all of the software authored by Mike Herman to Q
 __author__ = 'Herman'
 # !/usr/bin/env python3
 # -*- coding: UTF-8 -*-
-import urllib.request, urllib.parse
-import datetime, time
-import xml.etree.ElementTree as etree
+import datetime
+import calendar
+import functools
+import copy
+import itertools
+import operator
+try:
+    from lxml import etree  # C parser, much faster than ElementTree on large query responses
+except ImportError:
+    import xml.etree.ElementTree as etree
 import csv
+import io
 import smtplib
 import json
 import base64
 import re
+import types
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
 
 import os
+import uuid
 import pytz
+try:
+    from zoneinfo import ZoneInfo   # C implementation of the IANA timezone rules
+    EASTERN = ZoneInfo('America/New_York')
+except (ImportError, KeyError):    # Python < 3.9, or no timezone data installed
+    EASTERN = pytz.timezone('US/Eastern')
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    import numpy
+except ImportError:    # numpy is optional, and only used by EpochToDateArray
+    numpy = None
+try:
+    import pandas
+except ImportError:    # pandas is optional, and only used by csvSort for very large files
+    pandas = None
+try:
+    import httpx
+except ImportError:    # httpx is optional, and only used by QuickbaseAction.performActionAsync
+    httpx = None
 # from urllib.parse import urlparse
 # from influxdb import InfluxDBClient
 
 import quickbase
 DEFAULT_TIMEOUT = 10  # default request timeout in seconds
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes held in memory at a time when saving downloads to disk
+POOL_MAXSIZE = 32    # connections kept open per host by each pooled session
+CSV_SORT_PANDAS_THRESHOLD = 50 * 1024 * 1024    # csvSort hands files larger than this (in bytes) to pandas
+
+
+def _newSession():
+    """Creates a requests.Session which keeps connections to Quickbase alive between calls, so that each request does
+    not pay for a new TCP and TLS handshake"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_SESSION = _newSession()    # shared by the module-level helper functions
+
+
+@functools.lru_cache(maxsize=None)
+def _actionHeaders(action):
+    """Request headers for a Quickbase API action. The same mapping is shared by every call with the same action, so it
+    is returned read-only; copy it with dict() to add headers to one request"""
+    return types.MappingProxyType({"Content-Type": "application/xml", "QUICKBASE-ACTION": action})
+
+
+def _postXML(url, data, action, stream=False, session=None):
+    """POSTs an XML request body to Quickbase using the given session, or the shared one
+
+    :param url: full request url, including the dbid
+    :param data: request body, bytes
+    :param action: Quickbase API action, e.g. API_DoQuery
+    :param stream: if True, the body is left unread so it can be consumed from response.raw
+    :param session: requests.Session to send the request on, e.g. QuickbaseApp.session. Defaults to _SESSION
+    :return: requests.Response
+    """
+    response = (session or _SESSION).post(url, data=data, headers=_actionHeaders(action), timeout=DEFAULT_TIMEOUT, stream=stream)
+    response.raise_for_status()
+    return response
+
 
 class AuthenticationError(Exception):
 
@@ -136,6 +207,9 @@ class QuickbaseApp():
         self.base_url = baseurl   # generally https://something.quickbase.com/db/
         self.ticket = ticket    # authentication ticket
         self.token = token      # authentication token
+        self.session = _newSession()    # keep-alive connection pool used by this app's QuickbaseActions
+        self._fid_dicts = dict()    # fid to field name maps by (url, clist), see _fidDict
+        self._aclient = None    # httpx.AsyncClient used by performActionAsync, created by asyncClient on first use
 
         if tables == None:
             self.tables = generateTableDict('./site-config.cfg')
@@ -163,6 +237,112 @@ class QuickbaseApp():
         if kwargs:
             self.__dict__.update(kwargs)    # optional arguments
 
+    def tableUrl(self, dbid_key):
+        """Request url for a table, built from the current base_url and tables
+
+        :param dbid_key: dbid label. Any dbid_key not in self.tables is assumed to be the actual dbid string
+        :return: String, https://<domain>.quickbase.com/db/<dbid>
+        """
+        return self.base_url + self.tables.get(dbid_key, dbid_key)
+
+    def _fidDict(self, url, clist, record):
+        """Map of field id to field name for the fids in a query clist. It only depends on the table and the clist, so
+        it is built from the first record of the first response and reused by every later query with the same clist.
+        Each call returns a new copy, so an action's fid_dict can be changed without affecting other actions
+
+        :param url: request url of the table
+        :param clist: period-separated field ids
+        :param record: dict of field name and value, e.g. QuickbaseResponse.values[0]
+        :return: dict
+        """
+        fid_dict = self._fid_dicts.get((url, clist))
+        if fid_dict is None:
+            fid_list = clist.split('.')
+            field_names = itertools.islice(record, len(fid_list))
+            # CAUTION: Quickbase will not tell you if you include an invalid field ID in a clist! Any fids left over
+            # map to None
+            fid_dict = self._fid_dicts[(url, clist)] = dict(itertools.zip_longest(fid_list, field_names))
+        return dict(fid_dict)
+
+    def asyncClient(self):
+        """The httpx.AsyncClient this app's QuickbaseActions use in performActionAsync. It is created on first use and
+        keeps its connections alive between requests, like self.session. An AsyncClient belongs to the event loop it was
+        first used on, so call aclose before that loop finishes
+
+        :return: httpx.AsyncClient
+        """
+        if httpx is None:
+            raise ImportError("performActionAsync requires httpx")
+        if self._aclient is None:
+            self._aclient = httpx.AsyncClient(timeout=DEFAULT_TIMEOUT,
+                                              limits=httpx.Limits(max_connections=POOL_MAXSIZE))
+        return self._aclient
+
+    async def aclose(self):
+        """Closes the httpx.AsyncClient opened by asyncClient, if any"""
+        if self._aclient is not None:
+            await self._aclient.aclose()
+            self._aclient = None
+
+    def batch(self, actions, max_workers=8):
+        """Performs several QuickbaseActions concurrently and returns their responses in the same order
+
+        Each action must be a separate QuickbaseAction object. Sharing one object between threads is not safe, since
+        performAction stores the response on the object itself.
+
+        :param actions: iterable of QuickbaseAction objects belonging to this app
+        :param max_workers: maximum number of requests in flight at once. Capped at POOL_MAXSIZE so that every thread
+        can hold a pooled connection
+        :return: list of the values returned by each performAction call
+        """
+        with ThreadPoolExecutor(max_workers=min(max_workers, POOL_MAXSIZE)) as executor:
+            return list(executor.map(lambda action: action.performAction(), actions))
+
+
+_QUERY_PREFIXES = ("query=", "qid=", "qname=")  # optional prefixes on a query string, stripped before sending
+
+# request body fragments, as bytes, so a body is built with a single b''.join and never passes through an
+# intermediate str. QuickbaseAction's bodies end with any options and then _XML_FOOTER
+_QUERY_HEADER = b'<qdbapi>%b%b'
+_RECORDS_HEADER = b'<qdbapi><msInUTC>%b</msInUTC>%b'
+_PURGE_BODY = b'<qdbapi>%b<%b>%b</%b>'
+_VARIABLE_BODY = b'<qdbapi><msInUTC>%b</msInUTC>%b<varname>%b</varname><value>%b</value>'
+_CUSTOM_BODY = b'<qdbapi>%b%b'
+_OPTIONS_BODY = b'<options>%b</options>'
+_XML_HEADER = b'<qdbapi><msInUTC>0</msInUTC><ticket>%b</ticket>'    # used by the module-level helper functions
+_XML_FOOTER = b'</qdbapi>'
+_XML_RID = b'<rid>%b</rid>'
+_XML_QUERY = b'<%b>%b</%b>'
+_XML_CLIST = b'<clist>%b</clist>'
+_XML_SLIST = b'<slist>%b</slist>'
+_XML_FIELD = b'<field fid="%b">%b</field>\n'
+_XML_CSV = b'<records_csv><![CDATA[%b]]></records_csv><clist>%b</clist><skipfirst>%b</skipfirst>'
+
+
+# request body builders shared by QuickbaseAction and the module-level helper functions. Each returns the utf-8
+# encoded elements inside <qdbapi>, after the authentication, so no request body is built as an intermediate str
+def _buildQueryBody(query, clist, slist, query_tag='query'):
+    """query, clist and slist elements of an API_DoQuery request. Empty elements are left out"""
+    parts = []
+    if query:  # queries with an empty query string are allowed and should return all records from the table
+        tag = _toBytes(query_tag)
+        parts.append(_XML_QUERY % (tag, _toBytes(escape(str(query))), tag))   # e.g. {'6'.EX.'AT&T'}
+    if clist:
+        parts.append(_XML_CLIST % _toBytes(clist))
+    if slist is not None and slist != "0":   # sort the responses on the listed field IDs
+        parts.append(_XML_SLIST % _toBytes(slist))
+    return b''.join(parts)
+
+
+def _buildFieldsBody(fieldValuePairs):
+    """field elements of an API_AddRecord or API_EditRecord request, keyed by fid. Values are xml escaped"""
+    return b''.join(_XML_FIELD % (_toBytes(field), _toBytes(escape(str(value))))
+                    for field, value in fieldValuePairs.items())
+
+
+def _buildCsvBody(csv_lines, clist, skip_first):
+    """records_csv, clist and skipfirst elements of an API_ImportFromCSV request"""
+    return _XML_CSV % (_toBytes(_cdata(csv_lines)), _toBytes(clist), _toBytes(skip_first))
 
 
 class QuickbaseAction():
@@ -194,21 +374,16 @@ class QuickbaseAction():
         self.record_count = record_count
         self.error_75_retry = error_75_retry
         self.options = options
-        if dbid_key is not None and dbid_key in self.app.tables: # build the request url
-            self.request = urllib.request.Request(self.app.base_url + self.app.tables[dbid_key])
-        elif dbid_key is None:
-            self.request = urllib.request.Request(self.app.base_url + self.app.tables['Application'])
-        else:   # assume any dbid_key not in app.tables is the actual dbid string
-            self.request = urllib.request.Request(self.app.base_url + dbid_key)
+        self.url = self.app.tableUrl('Application' if dbid_key is None else dbid_key)   # the request url
         self.action_string = action.lower() # assign the correct Quickbase API command based on the action string
-        if self.action_string in ["query", "qid", "qname", "querycount"]:
+        if self.action_string in ("query", "qid", "qname", "querycount"):
             self.action = "API_DoQuery"
             if self.action_string == 'querycount':
                 self.action = "API_DoQueryCount"
                 self.action_string = "query"
         elif self.action_string == "add":
             self.action = "API_AddRecord"
-        elif self.action_string == "edit" or action.lower() == "csv":
+        elif self.action_string in ("edit", "csv"):
             self.action = "API_ImportFromCSV"
         elif self.action_string == "purge":
             self.action = "API_PurgeRecords"
@@ -219,84 +394,104 @@ class QuickbaseAction():
         #     self.action_string = "query"
         else:
             self.action = action
-        self.request.add_header("Content-Type", "application/xml")
-        self.request.add_header("QUICKBASE-ACTION", self.action)
+        self.headers = _actionHeaders(self.action)
         self.return_records = return_records    # return the records from the response, or the response itself
         self.response = None
         self.slist = slist  # sort list
         self.data = data    # query/command data
         if type(clist) == list: # clist can be a list or a string
-            clist_string = ""
-            for fid in clist:
-                clist_string += fid + "."
-            self.clist = clist_string[:-1]
+            self.clist = '.'.join(map(str, clist))
         else:
             self.clist = clist
         self.query = query
-        if self.action_string == "query" or \
-                self.action_string == "qid" or \
-                self.action_string == 'qname' or \
-                self.action_string == 'querycount':
+        if self.action_string in ("query", "qid", "qname"):  # querycount was mapped to query above
             self.buildQuery()
         elif self.action_string == "purge": # purge removes all matching records and should be used with caution
             self.confirmation = confirmation
             self.buildPurge()
         elif self.action_string == "add":   # add a single record
             self.buildAdd()
-        elif self.action_string == "edit" or self.action_string == "csv":   # it is easy enough to edit records using
-                                                                            # the csv method.
+        elif self.action_string in ("edit", "csv"):  # it is easy enough to edit records using the csv method.
             self.buildCSV()
 
         elif self.action_string == "variable":
             self.buildVariable()
 
         else:   # implies an action not otherwise handled
-            self.data = """
-            <qdbapi>
-                %s
-                %s""" % (self.app.authentication_string, custom_body)
-
-        if self.options is not None:  # custom options
-            self.data = self.data + """
-            <options>%s</options>
-            """ % self.options
-        self.data = self.data + """
-                    </qdbapi>
-                        """
-        self.request.data = self.data.encode('utf-8')
-
-
-    def performAction(self, retry=False, **kwargs):
+            self._setBody(_CUSTOM_BODY % (self._authentication(), _toBytes(custom_body)))
+
+    def _authentication(self):
+        """The app's authentication element, utf-8 encoded for the request body"""
+        return _toBytes(self.app.authentication_string)
+
+    def _setBody(self, *parts):
+        """Joins the request body sent by performAction, adding any custom options and the closing tag"""
+        options = b'' if self.options is None else _OPTIONS_BODY % _toBytes(escape(self.options))
+        self.body = b''.join(parts + (options, _XML_FOOTER))
+
+
+    def performAction(self, retry=False, stream=False, **kwargs):
         """Performs the action defined by the QuickbaseAction object, and maps the response to an attribute
 
+        :param stream: if True, a query returns a generator of record dicts parsed while the response downloads instead,
+        and nothing is mapped to attributes. See streamRecords
         :return: response
         """
-        self.response_object = urllib.request.urlopen(self.request, timeout=DEFAULT_TIMEOUT) # do the thing
+        if stream:
+            return self.streamRecords()
+        self.response_object = self.app.session.post(self.url, data=self.body, headers=self.headers,
+                                                     timeout=DEFAULT_TIMEOUT) # do the thing
+        self.response_object.raise_for_status()
+        if self._readResponse(retry):
+            return self.performAction(retry=True)
+        return self._handleResponse()
+
+    async def performActionAsync(self, retry=False):
+        """Performs the action like performAction, but sends the request on the app's httpx.AsyncClient so that many
+        actions can be awaited concurrently (see gatherActions). Requires httpx
 
+        :return: response
+        """
+        self.response_object = await self.app.asyncClient().post(self.url, content=self.body, headers=self.headers)
+        self.response_object.raise_for_status()
+        if self._readResponse(retry):
+            return await self.performActionAsync(retry=True)
+        if self.errcode == '75':    # recursive_query pages through the records with blocking requests
+            return await asyncio.get_running_loop().run_in_executor(None, self._handleResponse)
+        return self._handleResponse()
+
+    def _readResponse(self, retry):
+        """Reads the status, content and error code from self.response_object. If Quickbase rejected the authentication
+        type, the app is switched to the other one and True is returned so that the caller sends the action again
+        """
         # Analytics().collect(tags={'action': self.action})
-        self.status = self.response_object.status   # status response. Hopefully starts with a 2
-        self.content = self.response_object.read().replace(b'<BR/>', b'')
-        self.head_content = etree.fromstring(self.content.split(b'</errtext>')[0]+b'</errtext>\r\n</qdbapi>')
+        self.status = self.response_object.status_code   # status response. Hopefully starts with a 2
+        self.content = self.response_object.content.replace(b'<BR/>', b'')
+        # parse only the header of the response. Slicing up to </errtext> avoids split() copying the whole body
+        head_end = self.content.find(b'</errtext>')
+        self.head_content = etree.fromstring((self.content if head_end < 0 else self.content[:head_end]) +
+                                             b'</errtext>\r\n</qdbapi>')
         self.errcode = self.head_content.find('errcode').text
         self.errtext = self.head_content.find('errtext').text
 
         if self.errcode == '4':
             if retry:
                 raise AuthenticationError
-            self.app.authentication_string = self.app.authentication_string.replace('ticket', 'usertoken')
-            self.data = self.data.replace('ticket', 'usertoken')
-            self.request.data = self.request.data.replace(b'ticket', b'usertoken')
-            self.app.authentication_type = 'usertoken'
-            self.performAction(retry=True)
+            self._switchAuthentication('ticket', 'usertoken')
+            return True
         elif self.errcode == '83':
             if retry:
                 raise AuthenticationError
-            self.app.authentication_string = self.app.authentication_string.replace('usertoken', 'ticket')
-            self.data = self.data.replace('usertoken', 'ticket')
-            self.request.data = self.request.data.replace(b'usertoken', b'ticket')
-            self.app.authentication_type = 'ticket'
-            self.performAction(retry=True)
-        elif self.errcode == '75':  # this will happen with very large queries
+            self._switchAuthentication('usertoken', 'ticket')
+            return True
+        return False
+
+    def _handleResponse(self):
+        """Maps the content of a successful response to attributes
+
+        :return: the value returned by performAction
+        """
+        if self.errcode == '75':  # this will happen with very large queries
             self.error_75_retry = True
             self.response = recursive_query(self).response
         elif self.errcode == '82':
@@ -322,7 +517,7 @@ class QuickbaseAction():
                 self.raw_response = self.etree_content.find('numMatches')
                 self.response = QuickbaseResponse(self.raw_response)
                 return self.raw_response.text
-            elif self.action_string != 'csv':
+            elif self.action_string not in ("edit", "csv"):
                 if len(self.etree_content) != 0 and \
                         type(self.etree_content) == list and \
                         type(self.etree_content[0]) == dict:
@@ -339,19 +534,12 @@ class QuickbaseAction():
                 else:
                     self.raw_response = list()
                     for content in self.etree_content:
-                        self.raw_response.append(content.getchildren())
+                        self.raw_response.append(list(content))
                     self.response = QuickbaseResponse(self.raw_response)
                 if not self.action_string == "add" and not self.action_string == "purge":
                     if self.clist and len(self.response.values) != 0:
-                        fid_list = self.clist.split('.')
-                        try:
-                            field_list = [x for x in self.response.values[0]]
-                            counter = 0
-                            for fid in fid_list:
-                                self.fid_dict[fid] = field_list[counter]  # map field names to field id numbers
-                                counter += 1
-                        except IndexError:
-                            self.fid_dict[fid] = None   #CAUTION: Quickbase will not tell you if you include an invalid field ID in a clist!
+                        # map field names to field id numbers
+                        self.fid_dict = self.app._fidDict(self.url, self.clist, self.response.values[0])
                     else:
                         self.fid_dict = None
                     if not self.return_records:
@@ -359,33 +547,20 @@ class QuickbaseAction():
                     else:
                         return self.raw_response
                 else:
-                    response_dict = {'errcode': self.etree_content.find('errcode').text,
-                                     'errtext': self.etree_content.find('errtext').text}
-                    if self.etree_content.find('rid') is not None:
-                        response_dict['rid'] = self.etree_content.find('rid').text  # record ids of new records
-                    else:
-                        response_dict['rid'] = None
-                    if self.etree_content.find('errdetail') is not None:
-                        response_dict['errdetail'] = self.etree_content.find('errdetail').text
-                    else:
-                        response_dict['errdetail'] = None
+                    # one walk over the top level of the response instead of a find() per tag
+                    response_fields = {child.tag: child.text for child in self.etree_content}
+                    response_dict = {'errcode': response_fields['errcode'],
+                                     'errtext': response_fields['errtext'],
+                                     'rid': response_fields.get('rid'),  # record ids of new records
+                                     'errdetail': response_fields.get('errdetail')}
                     return response_dict
-            if self.action_string == 'csv' or self.action_string == 'edit':
-                resp = etree.fromstring(self.content)
-                if resp.find('num_recs_input') is not None: # records received from the query
-                    self.num_recs_input = resp.find('num_recs_input').text
-                else:
-                    self.num_recs_input = "0"
-                if resp.find('num_recs_added') is not None: # records created
-                    self.num_recs_added = resp.find('num_recs_added').text
-                else:
-                    self.num_recs_added = "0"
-                if resp.find('num_recs_updated') is not None:   # records updated
-                    self.num_recs_updated = resp.find('num_recs_updated').text
-                else:
-                    self.num_recs_updated = "0"
+            if self.action_string in ("edit", "csv"):
+                resp = self.etree_content    # already parsed above
+                self.num_recs_input = resp.findtext('num_recs_input', '0')  # records received from the query
+                self.num_recs_added = resp.findtext('num_recs_added', '0')  # records created
+                self.num_recs_updated = resp.findtext('num_recs_updated', '0')  # records updated
                 self.rid_list = list()
-                rids = etree.fromstring(self.content).find('rids')  # record id numbers
+                rids = resp.find('rids')  # record id numbers
                 try:
                     for rid in rids.findall('rid'):
                         self.rid_list.append(rid.text)
@@ -394,89 +569,51 @@ class QuickbaseAction():
                     print(err)
                     print(self.content)
 
+    def _switchAuthentication(self, old_type, new_type):
+        """Switches the app and this action between ticket and usertoken authentication
+
+        The already encoded body is reused. Only the first opening and closing authentication tags are renamed, so a
+        multi-MB csv body is not re-encoded, and record data which happens to contain the word 'ticket' is left alone
+        """
+        self.app.authentication_string = self.app.authentication_string.replace(old_type, new_type)
+        self.app.authentication_type = new_type
+        for old_tag, new_tag in (('<%s>' % old_type, '<%s>' % new_type), ('</%s>' % old_type, '</%s>' % new_type)):
+            self.body = self.body.replace(old_tag.encode('utf-8'), new_tag.encode('utf-8'), 1)
+
+    def streamRecords(self):
+        """Performs a query action, yielding each record as a dict of field name and value while the response is still
+        downloading. Unlike performAction, the whole response is never held in memory, and authentication and error 75
+        retries are not attempted
+
+        :return: generator of dicts
+        """
+        with self.app.session.post(self.url, data=self.body, headers=self.headers, timeout=DEFAULT_TIMEOUT,
+                                   stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True  # undo any gzip content encoding before parsing
+            yield from iterparseRecords(response.raw)
+
     def buildQuery(self):
-        encoding = '<encoding>utf-8</encoding>' if self.force_utf8 else ''
-        if self.query:  # build the query request
-            if "query=" in self.query or "qid=" in self.query or "qname=" in self.query:
-                v, self.query = self.query.split("=", 1)
-            if self.slist == "0":   # sort the responses on the listed field IDs
-                self.data = """
-                                <qdbapi>
-                                    %s
-                                    %s
-                                    <%s>%s</%s>
-                                    """ % (
-                encoding, self.app.authentication_string, self.action_string, self.query, self.action_string)
-                if clist:
-                    self.data = self.data + """<clist>%s</clist>
-                                """ % (self.clist)
-
-            else:   # responses sorted by the default field
-                self.data = """
-                                <qdbapi>
-                                    %s
-                                    %s
-                                    <%s>%s</%s>
-                                    """ % (
-                encoding, self.app.authentication_string, self.action_string, self.query, self.action_string)
-                if self.clist:
-                    self.data = self.data + """<clist>%s</clist>
-                                """ % (self.clist)
-                self.data = self.data + """<slist>%s</slist>
-                                """ % (self.slist)
-
-        else:  # queries with an empty query string are allowed and should return all records from the table
-            if self.slist == "0":
-                self.data = """
-                                <qdbapi>
-                                    %s
-                                    %s
-                                    """ % (encoding, self.app.authentication_string)
-                if self.clist:
-                    self.data = self.data + """<clist>%s</clist>
-                                """ % (self.clist)
-            else:
-                self.data = """
-                                <qdbapi>
-                                    %s
-                                    %s
-                                    """ % (encoding, self.app.authentication_string)
-                if self.clist:
-                    self.data = self.data + """<clist>%s</clist>
-                                """ % (self.clist)
-                self.data = self.data + """<slist>%s</slist>
-                                """ % (self.slist)
+        if self.query and self.query.startswith(_QUERY_PREFIXES):
+            self.query = self.query.partition("=")[2]
+        encoding = b'<encoding>utf-8</encoding>' if self.force_utf8 else b''
+        self._setBody(_QUERY_HEADER % (encoding, self._authentication()),
+                      _buildQueryBody(self.query, self.clist, self.slist, self.action_string))
 
     def buildAdd(self):
         assert type(self.data) == dict
-        recordInfo = ""
-        for field in self.data:
-            recordInfo += '<field fid="' + str(field) + '">' + str(self.data[field]) + "</field>\n"
-        self.data = """
-                        <qdbapi>
-                            <msInUTC>%s</msInUTC>
-                            %s
-                            %s
-
-                        """ % (self.send_time_in_utc, self.app.authentication_string, recordInfo)
+        self._setBody(_RECORDS_HEADER % (_toBytes(self.send_time_in_utc), self._authentication()),
+                      _buildFieldsBody(self.data))
 
     def buildPurge(self):
         assert self.confirmation
         assert self.query # use qid=1 instead
         if self.confirmation and self.query:
-            if "query=" in self.query:
-                v, self.query = self.query.split("=", 1)
-                query_type = "query"
-            elif "qid=" in self.query:
-                v, self.query = self.query.split("=", 1)
-                query_type = "qid"
-            else:
-                query_type = "query"
-            self.data = """
-                           <qdbapi>
-                               %s
-                               <%s>%s</%s>
-                           """ % (self.app.authentication_string, query_type, self.query, query_type)
+            query_type = "query"
+            if self.query.startswith(("query=", "qid=")):
+                query_type, _, self.query = self.query.partition("=")
+            query_tag = _toBytes(query_type)
+            self._setBody(_PURGE_BODY % (self._authentication(), query_tag, _toBytes(escape(self.query)), query_tag))
         return None
 
     def buildVariable(self):
@@ -485,120 +622,29 @@ class QuickbaseAction():
         for variable in self.data:
             variable_name = variable
             variable_value = self.data[variable]
-            self.data = """
-                            <qdbapi>
-                                <msInUTC>%s</msInUTC>
-                                %s
-                                <varname>%s</varname>
-                                <value>%s</value>
-                            """ % (self.send_time_in_utc, self.app.authentication_string, variable_name, variable_value)
+        self._setBody(_VARIABLE_BODY % (_toBytes(self.send_time_in_utc), self._authentication(),
+                                        _toBytes(escape(str(variable_name))), _toBytes(escape(str(variable_value)))))
 
     def buildCSV(self):
         if type(self.data) == str:  # data can be type string, list or dict
-            if '"' in self.data:
-                self.data = self.data.replace('"', '""')  # Quickbase requires double quotes for quotes within
-                self.data = '"' + self.data + '"'  # data
-            elif "," in self.data:  # commas are special characters so strings containing them need to be quoted
-                self.data = '"' + self.data + '"'
-            if '\n' in self.data and not (self.data[0] == '"' and self.data[-1] == '"'):  # \n is also a special
-                self.data = '"' + self.data + '"'  # character
-            self.data = """
-            <qdbapi>
-                <msInUTC>%s</msInUTC>
-                %s
-                <records_csv>
-                    <![CDATA[
-                        %s
-                    ]]>
-                </records_csv>
-                <clist>%s</clist>
-                <skipfirst>%s</skipfirst>
-
-                """ % (self.send_time_in_utc, self.app.authentication_string, self.data, self.clist, self.skip_first)
-        elif type(self.data) == list:
-            csv_lines = ""
-            if type(self.data[0]) == list:  # a list of lists works as well
-                for line in self.data:
-                    for item in line:
-                        if item is None:  # quickbase chokes unless None is converted to an empty string
-                            item = ''
-                        assert type(item) == str
-                        if '"' in item:
-                            item = item.replace('"', '""')
-                            item = '"' + item + '"'
-                        elif "," in item:
-                            item = '"' + item + '"'
-                        if '\n' in item and not (item[0] == '"' and item[-1] == '"'):
-                            item = '"' + item + '"'
-                        csv_lines += item + ","
-                    csv_lines = csv_lines[:-1] + "\n"
-            elif type(self.data[0]) == str:
-                for item in self.data:
-                    if item is None:
-                        item = ''
-                    try:
-                        assert type(item) == str
-                    except AssertionError:
-                        print("wrong item type")
-                        print(type(item))
-                        print(item)
-                        if item is None:  # quickbase chokes unless None is converted to an empty string
-                            item = ""
-                    if '"' in item:
-                        item = item.replace('"', '""')
-                        item = '"' + item + '"'
-                    elif "," in item:
-                        item = '"' + item + '"'
-                    if '\n' in item and not (item[0] == '"' and item[-1] == '"'):
-                        item = '"' + item + '"'
-                    csv_lines += item + ","
-                csv_lines = csv_lines[:-1] + "\n"
-            self.data = """
-            <qdbapi>
-                <msInUTC>%s</msInUTC>
-                %s
-                <records_csv>
-                    <![CDATA[
-                        %s
-                    ]]>
-                </records_csv>
-                <clist>%s</clist>
-                <skipfirst>%s</skipfirst>
-
-                """ % (self.send_time_in_utc, self.app.authentication_string, csv_lines, self.clist, self.skip_first)
-        elif type(self.data) == dict:  # dicts are preferred for editing existing records. Dict key is record ID
-            csv_lines = ""
-            assert '3' in self.clist.split('.')
-            for record_id in self.data:
-                assert type(record_id) == str and type(self.data[record_id]) == list
-                line = self.data[record_id]
-                csv_lines += record_id + ','
-                for item in line:
-                    if item is None:  # quickbase chokes unless None is converted to an empty string
-                        item = ''
-                    assert type(item) == str
-                    if '"' in item:
-                        item = item.replace('"', '""')
-                        item = '"' + item + '"'
-                    elif "," in item:
-                        item = '"' + item + '"'
-                    if '\n' in item and not (item[0] == '"' and item[-1] == '"'):
-                        item = '"' + item + '"'
-                    csv_lines += item + ","
-                csv_lines = csv_lines[:-1] + "\n"
-            self.data = """
-            <qdbapi>
-                <msInUTC>%s</msInUTC>
-                %s
-                <records_csv>
-                    <![CDATA[
-                        %s
-                    ]]>
-                </records_csv>
-                <clist>%s</clist>
-                <skipfirst>%s</skipfirst>
-
-                """ % (self.send_time_in_utc, self.app.authentication_string, csv_lines, self.clist, "0")
+            csv_lines = self.data
+            if '"' in csv_lines:
+                csv_lines = csv_lines.replace('"', '""')  # Quickbase requires double quotes for quotes within
+                csv_lines = '"' + csv_lines + '"'  # data
+            elif "," in csv_lines:  # commas are special characters so strings containing them need to be quoted
+                csv_lines = '"' + csv_lines + '"'
+            if '\n' in csv_lines and not (csv_lines[0] == '"' and csv_lines[-1] == '"'):  # \n is also a special
+                csv_lines = '"' + csv_lines + '"'  # character
+            self._setBody(_RECORDS_HEADER % (_toBytes(self.send_time_in_utc), self._authentication()),
+                          _buildCsvBody(csv_lines, self.clist, self.skip_first))
+        elif type(self.data) in (list, dict):   # a list of lists works as well
+            skip_first = self.skip_first
+            if type(self.data) == dict:  # dicts are preferred for editing existing records. Dict key is record ID
+                assert '3' in self.clist.split('.')
+                skip_first = "0"
+            csv_lines = _csvText(self.data)
+            self._setBody(_RECORDS_HEADER % (_toBytes(self.send_time_in_utc), self._authentication()),
+                          _buildCsvBody(csv_lines, self.clist, skip_first))
 
 class QuickbaseResponse():
     """
@@ -607,48 +653,121 @@ class QuickbaseResponse():
     def __init__(self, response):
 
         self.records = response
-        self.values = []    # each record is a dict key=field name, value=field value
-        for record in self.records:
-            record_dict = dict()
-            for item in record:
-                record_dict[item.tag] = item.text
-            self.values.append(record_dict)
+        # each record is a dict key=field name, value=field value
+        self.values = [{item.tag: item.text for item in record} for record in self.records]
+
+
+class QBBatchWriter():
+    """
+    Buffers record adds and edits and sends them to Quickbase with API_ImportFromCSV when the with block exits, so a
+    batch costs one request per set of fields written instead of one QBAdd/QBEdit request per record
+
+        with QBBatchWriter(app, 'Tasks') as writer:
+            writer.add({'6': 'new task'})
+            writer.edit('12', {'6': 'renamed task'})
+    """
+    def __init__(self, app, dbid_key):
+        """
+
+        :param app: class QuickbaseApp
+        :param dbid_key: dbid label
+        """
+        self.app = app
+        self.dbid_key = dbid_key
+        self.rid_list = []  # record ids added or edited by each flush
+        self._batches = dict()  # csv lines keyed by the tuple of field ids they write
+
+    def add(self, fields):
+        """Queues a new record. fields is a dict of fid and value"""
+        self._buffer('', fields)    # a blank record id tells Quickbase to create the record
+
+    def edit(self, rid, fields):
+        """Queues an edit of record rid. Only the fids in fields are written"""
+        self._buffer(rid, fields)
+
+    def _buffer(self, rid, fields):
+        fids = tuple(sorted(str(fid) for fid in fields))
+        if '3' in fids:
+            raise ValueError("pass the record ID to edit() rather than as field 3")
+        values = {str(fid): value for fid, value in fields.items()}
+        line = [str(rid)] + ['' if values[fid] is None else str(values[fid]) for fid in fids]
+        self._batches.setdefault(fids, []).append(line)
+
+    def flush(self):
+        """Sends everything queued so far, one API_ImportFromCSV request per distinct set of fids. Each batch is dropped
+        from the queue as soon as its request succeeds, so if a request fails, calling flush again only resends the
+        batches that were not written
+
+        :return: list of record ids added or edited
+        """
+        while self._batches:
+            fids, lines = next(iter(self._batches.items()))
+            action = QuickbaseAction(self.app, self.dbid_key, 'csv', data=lines, clist='.'.join(('3',) + fids))
+            rids = action.performAction()
+            del self._batches[fids]
+            if rids:
+                self.rid_list.extend(rids)
+        return self.rid_list
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:    # nothing is sent if the with block raised
+            self.flush()
+
+
+# offsets returned by the tzinfo classes below, created once instead of on every call
+_TD_0 = datetime.timedelta(0)
+_TD_1H = datetime.timedelta(hours=1)
+_TD_M5H = datetime.timedelta(hours=-5)
+
+
+@functools.lru_cache(maxsize=64)
+def _dstWindow(year):
+    """Start and end of daylight saving time in the Eastern timezone for year, as naive datetimes. Cached, since
+    Eastern_tzinfo.dst is called several times for every datetime it converts"""
+    # 2 am on the second Sunday in March
+    dst_start = Eastern_tzinfo._FirstSunday(datetime.datetime(year, 3, 8, 2))
+    # 1 am on the first Sunday in November
+    dst_end = Eastern_tzinfo._FirstSunday(datetime.datetime(year, 11, 1, 1))
+    return dst_start, dst_end
 
 
 class Eastern_tzinfo(datetime.tzinfo):
-    """Implementation of the Eastern timezone."""
+    """Implementation of the Eastern timezone. Kept for existing callers; the module itself uses EASTERN, which also
+    follows the DST rules in force before 2007"""
 
     def utcoffset(self, dt):
-        return datetime.timedelta(hours=-5) + self.dst(dt)
+        return _TD_M5H + self.dst(dt)
 
-    def _FirstSunday(self, dt):
+    @staticmethod
+    def _FirstSunday(dt):
         """First Sunday on or after dt."""
         return dt + datetime.timedelta(days=(6 - dt.weekday()))
 
     def dst(self, dt):
-        # 2 am on the second Sunday in March
-        dst_start = self._FirstSunday(datetime.datetime(dt.year, 3, 8, 2))
-        # 1 am on the first Sunday in November
-        dst_end = self._FirstSunday(datetime.datetime(dt.year, 11, 1, 1))
+        dst_start, dst_end = _dstWindow(dt.year)
 
         if dst_start <= dt.replace(tzinfo=None) < dst_end:
-            return datetime.timedelta(hours=1)
+            return _TD_1H
         else:
-            return datetime.timedelta(hours=0)
+            return _TD_0
 
     def tzname(self, dt):
-        if self.dst(dt) == datetime.timedelta(hours=0):
+        if self.dst(dt) == _TD_0:
             return "EST"
         else:
             return "EDT"
 
 
 class UTC(datetime.tzinfo):
+    """Kept for existing callers; datetime.timezone.utc is equivalent"""
     def utcoffset(self, dt):
-        return datetime.timedelta(hours=0)
+        return _TD_0
 
     def dst(self, dt):
-        return datetime.timedelta(hours=0)
+        return _TD_0
 
     def tzname(self, dt):
         return "UTC"
@@ -671,6 +790,66 @@ def generate_quickbase_app(config='app-config.cfg', baseUrl="", auth_key=None, *
     return APP
 
 
+async def gatherActions(actions, concurrency=8):
+    """
+    Performs several QuickbaseActions concurrently with performActionAsync, keeping at most concurrency requests in
+    flight. Each action must be a separate QuickbaseAction object. For callers without an event loop, see
+    QuickbaseApp.batch
+    :param actions: iterable of QuickbaseAction objects
+    :param concurrency: maximum number of requests in flight at once
+    :return: list of the values returned by each action, in the same order as actions
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def perform(action):
+        async with semaphore:
+            return await action.performActionAsync()
+
+    return await asyncio.gather(*(perform(action) for action in actions))
+
+
+_LXML = hasattr(etree, 'LXML_VERSION')  # lxml's iterparse supports tag filtering and removing parsed siblings
+
+
+def _iterparseTags(*tags):
+    """iterparse keyword arguments which restrict the events to the given tags. lxml filters them in C, so the loop is not
+    entered for every field element. ElementTree has no such option, and callers still check element.tag themselves"""
+    if _LXML:
+        return {'tag': tags}
+    return {}
+
+
+def _releaseElement(element):
+    """Frees a record element once it has been read. With lxml the emptied elements before it are also removed from
+    their parent, so the tree iterparse builds does not keep one empty element per record"""
+    element.clear()
+    if _LXML:
+        parent = element.getparent()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def iterparseRecords(source):
+    """
+    Parses a Quickbase query response incrementally, yielding each record as a dict of field name and value. Each record
+    element is cleared once it has been read, so memory use does not grow with the number of records
+    :param source: file-like object (e.g. a streamed http response) or filename
+    :return: generator of dicts
+    """
+    errcode = None
+    for event, element in etree.iterparse(source, events=('end',), **_iterparseTags('record', 'errcode', 'errtext')):
+        if element.tag == 'record':
+            # multi-line text fields contain <BR/> elements, which performAction strips out of the raw content
+            yield {field.tag: field.text if len(field) == 0 else ''.join(field.itertext()) for field in element}
+            _releaseElement(element)
+        elif element.tag == 'errcode':
+            errcode = element.text
+        elif element.tag == 'errtext' and errcode != '0':
+            if errcode == '82':
+                raise QuickbaseQueryError
+            raise QuickbaseError('Quickbase has returned error %s: %s' % (errcode, element.text))
+
+
 def parseQueryContent(content):
     records = content.split(b'</record>')
     full_content = list()
@@ -713,6 +892,10 @@ def parseSchemaContent(content, include_field_details=False):
     return full_content
 
 
+_SCHEMA_BODY = b'<qdbapi>%b</qdbapi>'
+_NON_ALPHANUMERIC = re.compile(r'\W')   # compiled once at import, used to build field keys in getTableFIDDict
+
+
 def getTableFIDDict(app_object, dbid, return_alphanumeric=False, return_standard=True, return_field_details=False, return_reverse=False):
     """
     Uses API_GetSchema to generate a dict of FIDs by field name. Note that the responses here include a lot of extra
@@ -725,24 +908,15 @@ def getTableFIDDict(app_object, dbid, return_alphanumeric=False, return_standard
     :param dbid:
     :return:
     """
-    if dbid in app_object.tables:
-        table = app_object.tables[dbid]
-    else:
-        table = dbid
-    request = urllib.request.Request(app_object.base_url + table)
-    request.add_header("Content-type", "application/xml")
-    request.add_header("QUICKBASE-ACTION", "API_GetSchema")
-    data = """
-    <qdbapi>
-        %s
-    </qdbapi>""" % (app_object.authentication_string)
-    request.data = data.encode('utf-8')
-    response = urllib.request.urlopen(request, timeout=DEFAULT_TIMEOUT)
-    status = response.status
+    data = _SCHEMA_BODY % _toBytes(app_object.authentication_string)
+    response = app_object.session.post(app_object.tableUrl(dbid), data=data, timeout=DEFAULT_TIMEOUT,
+                                       headers=_actionHeaders("API_GetSchema"))
+    response.raise_for_status()
+    status = response.status_code
     field_dict = dict()
-    alphanumeric_regex = re.compile('\W')
+    alphanumeric_regex = _NON_ALPHANUMERIC
     if status == 200:
-        response_content = response.read().replace(b'<BR/>', b'')
+        response_content = response.content.replace(b'<BR/>', b'')
         full_content = parseSchemaContent(response_content, return_field_details)
         if return_standard:
             for field_label in full_content:
@@ -766,18 +940,59 @@ def generateTableDict(import_filename):
     :return table_dict: the table dict
     """
     table_dict = dict()
-    with open(import_filename, 'r') as csv_file:
-        r = csv.reader(csv_file)
-        for row in r:
-            if row[0] not in table_dict:
-                table_dict[row[0]] = row[2]
-                table_dict[row[0].lower()] = row[2]
-            table_dict[row[1]] = row[2]
-            table_dict[row[1].lower()] = row[2]
+    with open(import_filename, 'r', newline='') as csv_file:
+        for app_name, table_name, dbid, *_ in csv.reader(csv_file):
+            if app_name not in table_dict:
+                table_dict[app_name] = dbid
+                table_dict[app_name.lower()] = dbid
+            table_dict[table_name] = dbid
+            table_dict[table_name.lower()] = dbid
     return table_dict
 
 
-def QBQuery(url, ticket, dbid, request, clist, slist="0", returnRecords=False):
+def _toBytes(value):
+    """utf-8 encoded form of value, for filling in the XML fragments above"""
+    return str(value).encode('utf-8')
+
+
+def _csvLines(rows):
+    """Formats rows (lists of values) as csv text. Values containing commas, quotes or line breaks are quoted, and None
+    becomes an empty string"""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue()
+
+
+@functools.singledispatch
+def _csvText(csvData):
+    """csv text for UploadCsv and QuickbaseAction.buildCSV, dispatched on the type of csvData. A list is one line, or
+    a list of lines; a dict maps record ids to lines. None for unsupported types"""
+    return None
+
+
+@_csvText.register(str)
+def _(csvData):
+    return csvData  # already csv formatted
+
+
+@_csvText.register(list)
+def _(csvData):
+    if csvData and type(csvData[0]) == list:    # a list of lines
+        return _csvLines(csvData)
+    return _csvLines([csvData])     # a single line
+
+
+@_csvText.register(dict)
+def _(csvData):
+    return _csvLines([record_id] + line for record_id, line in csvData.items())     # the key is the record id
+
+
+def _cdata(text):
+    """Makes text safe to place inside a CDATA section, by splitting any ]]> it contains across two sections"""
+    return text.replace(']]>', ']]]]><![CDATA[>')
+
+
+def QBQuery(url, ticket, dbid, request, clist, slist="0", returnRecords=False, session=None, stream=False):
     """
     DEPRECATED
     This function takes the base Quickbase URL, an authentication ticket, a database ID (DBID), a query and a clist, and
@@ -788,73 +1003,78 @@ def QBQuery(url, ticket, dbid, request, clist, slist="0", returnRecords=False):
     DBID: the ID of the table you want to reference (what comes after the /db/ and before the ?act=)
     Query:query={CONDITIONS}. Should not contain any HTML encoding
     Clist: a period-separated list of fields you want returned
+    returnRecords: if True, returns a list of record elements instead of the raw XML
+    session: optional requests.Session (e.g. app.session) to reuse its connections instead of the module's shared pool
+    stream: with returnRecords, returns a generator of record elements which are parsed as the response downloads,
+    rather than a list. Each element is a detached copy, so it stays intact after the next one is requested
     """
     action = 'API_DoQuery'
 
-    query = urllib.request.Request(url + dbid)
-    query.add_header("Content-Type", "application/xml")
-    query.add_header("QUICKBASE-ACTION", action)
-    if "query=" in request:
-        v, request = request.split("=", 1)
-    if slist == "0":
-        data = """
-            <qdbapi>
-                <msInUTC>%s</msInUTC>
-                <ticket>%s</ticket>
-                <query>%s</query>
-                <clist>%s</clist>
-            </qdbapi>
-        """ % ('0', ticket, request, clist)
-    else:
-        data = """
-            <qdbapi>
-                <msInUTC>%s</msInUTC>
-                <ticket>%s</ticket>
-                <query>%s</query>
-                <clist>%s</clist>
-                <slist>%s</slist>
-            </qdbapi>
-        """ % ('0', ticket, request, clist, slist)
-    query.data = data.encode('utf-8')
-    content = urllib.request.urlopen(query, timeout=DEFAULT_TIMEOUT).read()
+    if request.startswith("query="):
+        request = request[6:]
+    parts = [_XML_HEADER % _toBytes(ticket), _buildQueryBody(request, clist, slist), _XML_FOOTER]
 
     # Analytics().collect(tags={'action': action})
 
     if not returnRecords:
-        return content
-    else:
-        return etree.fromstring(content).findall('record')
-
-
-def QBAdd(url, ticket, dbid, fieldValuePairs):
+        return _postXML(url + dbid, b''.join(parts), action, session=session).content
+    records = _streamRecordElements(url + dbid, b''.join(parts), action, session)
+    if stream:
+        return records
+    return list(records)
+
+
+def _streamRecordElements(url, data, action, session=None):
+    """Generator behind QBQuery(returnRecords=True), yielding a detached copy of each record element as it is parsed
+    from the response. The parsed original is released straight away, so the partial tree does not grow"""
+    with _postXML(url, data, action, stream=True, session=session) as response:
+        response.raw.decode_content = True  # undo any gzip content encoding before parsing
+        for event, element in etree.iterparse(response.raw, events=('end',), **_iterparseTags('record')):
+            if element.tag == 'record':
+                record = copy.deepcopy(element)
+                _releaseElement(element)
+                yield record
+
+
+def QBAdd(url, ticket, dbid, fieldValuePairs, session=None):
     """
     DEPRECATED
     This function adds a record in Quickbase. fieldValuePairs should be a dictionary of fid and values, and must include
     all required fields (especially related client).
     fieldValuePairs must use fid values as key, not field names
+
+    :param session: optional requests.Session to send the request on instead of the shared one
+    :return: the response body as bytes. This used to be the urlopen response object, so call sites that did
+    response.read() should use the return value directly
     """
     action = 'API_AddRecord'
 
-    query = urllib.request.Request(url + dbid)
-    query.add_header("Content-Type", "application/xml")
-    query.add_header("QUICKBASE-ACTION", action)
-    recordInfo = ""
-    for field in fieldValuePairs:
-        recordInfo += '<field fid="' + str(field) + '">' + str(fieldValuePairs[field]) + "</field>\n"
-    data = """
-        <qdbapi>
-            <msInUTC>%s</msInUTC>
-            <ticket>%s</ticket>
-            %s
-        </qdbapi>
-    """ % ('0', ticket, recordInfo)
-
-    query.data = data.encode('utf-8')
-    response = urllib.request.urlopen(query, timeout=DEFAULT_TIMEOUT)
+    response = _postXML(url + dbid, _addBody(ticket, fieldValuePairs), action, session=session)
 
     # Analytics().collect(tags={'action': action})
 
-    return response
+    return response.content
+
+
+def QBAddMany(url, ticket, dbid, fieldValuePairsList, max_workers=16, session=None):
+    """
+    Adds several records in Quickbase, sending up to max_workers API_AddRecord requests at once over the shared
+    connection pool. Each item of fieldValuePairsList is a dict of fid and values, as for QBAdd
+
+    :param max_workers: maximum number of requests in flight at once. Capped at POOL_MAXSIZE
+    :param session: optional requests.Session to send the requests on instead of the shared one
+    :return: list of response bodies as bytes, in the same order as fieldValuePairsList
+    """
+    action = 'API_AddRecord'
+
+    bodies = [_addBody(ticket, fieldValuePairs) for fieldValuePairs in fieldValuePairsList]
+    with ThreadPoolExecutor(max_workers=min(max_workers, POOL_MAXSIZE)) as executor:
+        return list(executor.map(lambda data: _postXML(url + dbid, data, action, session=session).content, bodies))
+
+
+def _addBody(ticket, fieldValuePairs):
+    """API_AddRecord request body for QBAdd and QBAddMany"""
+    return b''.join((_XML_HEADER % _toBytes(ticket), _buildFieldsBody(fieldValuePairs), _XML_FOOTER))
 
 
 def EpochToDate(epochTime, include_time=False, convert_to_eastern_time=False, include_timezone=True):
@@ -862,106 +1082,81 @@ def EpochToDate(epochTime, include_time=False, convert_to_eastern_time=False, in
     Takes a Quickbase-generated time value (ms since the start of the epoch) and returns a datetime.date object
     If pulling directly from Quickbase, should be converted to eastern time
     """
-    if include_timezone:
-        if epochTime and not include_time:
-            tupleTime = time.gmtime(int(epochTime) / 1000)
-            realDate = datetime.date(tupleTime.tm_year, tupleTime.tm_mon, tupleTime.tm_mday)
-            return realDate
-        elif epochTime and include_time:
-            tupleTime = time.gmtime(int(epochTime) / 1000)
-            realDateTime = datetime.datetime(tupleTime.tm_year, tupleTime.tm_mon, tupleTime.tm_mday, tupleTime.tm_hour,
-                                             tupleTime.tm_min, tupleTime.tm_sec, tzinfo=pytz.UTC)
-            if convert_to_eastern_time:
-                realDateTime = realDateTime.astimezone(tz=pytz.timezone('US/Eastern'))
-            # realDateTime = realDateTime.astimezone(tz=Eastern_tzinfo())
-            return realDateTime
-        else:
-            return None
-    else:
-        if epochTime and not include_time:
-            tupleTime = time.gmtime(int(epochTime) / 1000)
-            realDate = datetime.date(tupleTime.tm_year, tupleTime.tm_mon, tupleTime.tm_mday)
-            return realDate
-        elif epochTime and include_time:
-            tupleTime = time.gmtime(int(epochTime) / 1000)
-            realDateTime = datetime.datetime(tupleTime.tm_year, tupleTime.tm_mon, tupleTime.tm_mday, tupleTime.tm_hour,
-                                             tupleTime.tm_min, tupleTime.tm_sec)
-            # if convert_to_eastern_time:
-            #     realDateTime = realDateTime.astimezone(tz=pytz.timezone('US/Eastern'))
-            # realDateTime = realDateTime.astimezone(tz=Eastern_tzinfo())
-            return realDateTime
-        else:
-            return None
+    if not epochTime:
+        return None
+    # whole seconds, floored as time.gmtime did, converted in one call to an aware UTC datetime
+    realDateTime = datetime.datetime.fromtimestamp(int(epochTime) // 1000, tz=datetime.timezone.utc)
+    if not include_time:
+        return realDateTime.date()
+    if not include_timezone:
+        return realDateTime.replace(tzinfo=None)
+    if convert_to_eastern_time:
+        realDateTime = realDateTime.astimezone(tz=EASTERN)
+    # realDateTime = realDateTime.astimezone(tz=Eastern_tzinfo())
+    return realDateTime
+
+
+def EpochToDateArray(epochTimes):
+    """
+    Vectorised form of EpochToDate for converting many Quickbase time values (ms since the start of the epoch) at once.
+    Returns a numpy datetime64[D] array of UTC dates, with NaT for empty values. Requires numpy
+    :param epochTimes: sequence or array of ints or numeric strings. '' and None are treated as empty
+    """
+    if numpy is None:
+        raise ImportError('EpochToDateArray requires numpy')
+    values = numpy.asarray(epochTimes)
+    empty = None
+    if values.dtype == object:  # e.g. a list containing None
+        values = numpy.where(values == None, '', values).astype(str)
+    if values.dtype.kind == 'U':    # Quickbase returns field values as strings, '' when empty
+        empty = values == ''
+        values = numpy.where(empty, '0', values)
+    dates = values.astype(numpy.int64).astype('datetime64[ms]').astype('datetime64[D]')
+    if empty is not None:
+        dates[empty] = numpy.datetime64('NaT')
+    return dates
 
 
 def DateToEpoch(regDate, include_time=False, convert_to_eastern_time=False, include_timezone=True):
     """
     takes a datetime object and returns an epoch time integer in a format that
-    quickbase can use. Assumes time in localtime and does necessary alterations to make it work with UTC if
-    convert_to_eastern_time is true
+    quickbase can use. The date (and time, if include_time) is read as UTC, and converted to eastern wall-clock time
+    first if convert_to_eastern_time is true. The result does not depend on the timezone of the local machine
     """
-    if include_timezone:
-        if not include_time:
-            date_object = datetime.datetime(regDate.year, regDate.month, regDate.day, tzinfo=pytz.UTC)
-            if convert_to_eastern_time:
-                utc_date_object = date_object.astimezone(tz=pytz.timezone('US/Eastern'))
-                # structTime = time.strptime(str(date_object.year) + str(date_object.month) + str(date_object.day) + " " +
-                #                            str(date_object.tzinfo),
-                #                            "%Y%m%d %Z")
-                epochTime = int(time.mktime(utc_date_object.timetuple()) * 1000)
-            else:
-                epochTime = int(time.mktime(date_object.timetuple()) * 1000)
-        else:
-            datetime_object = datetime.datetime(regDate.year, regDate.month, regDate.day, regDate.hour, regDate.minute,
-                                                regDate.second, tzinfo=pytz.UTC)
-            if convert_to_eastern_time:
-                utc_datetime_object = datetime_object.astimezone(tz=pytz.timezone('US/Eastern'))
-                # structTime = time.strptime(str(date_object.year) + str(date_object.month) + str(date_object.day) + " "
-                #                            + str(date_object.hour) + ":" + str(date_object.minute) + ":"
-                #                            + str(date_object.second) + " " + str(date_object.tzinfo),
-                #                            "%Y%m%d %H:%M:%S %Z")
-                epochTime = int(time.mktime(utc_datetime_object.timetuple()) * 1000)
-            else:
-                epochTime = int(time.mktime(datetime_object.timetuple()) * 1000)
+    if include_time:
+        date_object = datetime.datetime(regDate.year, regDate.month, regDate.day, regDate.hour, regDate.minute,
+                                        regDate.second, tzinfo=datetime.timezone.utc)
     else:
-        if not include_time:
-            date_object = datetime.datetime(regDate.year, regDate.month, regDate.day, tzinfo=pytz.UTC)
-            if convert_to_eastern_time:
-                utc_date_object = date_object.astimezone(tz=pytz.timezone('US/Eastern'))
-                # structTime = time.strptime(str(date_object.year) + str(date_object.month) + str(date_object.day) + " " +
-                #                            str(date_object.tzinfo),
-                #                            "%Y%m%d %Z")
-                epochTime = int(time.mktime(utc_date_object.timetuple()) * 1000)
-            else:
-                epochTime = int(time.mktime(date_object.timetuple()) * 1000)
-        else:
-            datetime_object = datetime.datetime(regDate.year, regDate.month, regDate.day, regDate.hour, regDate.minute,
-                                                regDate.second)
-            epochTime = int(time.mktime(datetime_object.timetuple()) * 1000)
+        date_object = datetime.datetime(regDate.year, regDate.month, regDate.day, tzinfo=datetime.timezone.utc)
+    if convert_to_eastern_time and (include_timezone or not include_time):
+        date_object = date_object.astimezone(tz=EASTERN)
+    epochTime = calendar.timegm(date_object.timetuple()) * 1000
     return (epochTime)
 
 
+_MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+_MONTH_LENGTHS_COMMON = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+_MONTH_LENGTHS_LEAP = (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+# read-only month lengths keyed by both abbreviated name and month number
+_MONTH_LENGTH_DICT_COMMON = types.MappingProxyType({
+    **dict(zip(_MONTH_NAMES, _MONTH_LENGTHS_COMMON)),
+    **{month: length for month, length in enumerate(_MONTH_LENGTHS_COMMON, 1)}})
+_MONTH_LENGTH_DICT_LEAP = types.MappingProxyType({
+    **dict(zip(_MONTH_NAMES, _MONTH_LENGTHS_LEAP)),
+    **{month: length for month, length in enumerate(_MONTH_LENGTHS_LEAP, 1)}})
+# MonthDict return values, indexed by calendar.isleap(year)
+_MONTHS = ((_MONTH_LENGTH_DICT_COMMON, _MONTH_LENGTHS_COMMON), (_MONTH_LENGTH_DICT_LEAP, _MONTH_LENGTHS_LEAP))
+
+
 def MonthDict(testDate):
     """
-    This function takes a date and returns a dictionary and an array to allow referencing the length of the month from
-    the date
+    This function takes a date and returns a read-only mapping and a tuple to allow referencing the length of the month
+    from the date
     """
-    if (testDate.year % 4 == 0):
-        monthLengthDict = {'Jan': 31, 'Feb': 29, 'Mar': 31, 'Apr': 30, 'May': 31, 'Jun': 30, 'Jul': 31,
-                           'Aug': 31, 'Sep': 30, 'Oct': 31, 'Nov': 30, 'Dec': 31,
-                           1: 31, 2: 29, 3: 31, 4: 30, 5: 31, 6: 30, 7: 31,
-                           8: 31, 9: 30, 10: 31, 11: 30, 12: 31}
-        monthLength = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    else:
-        monthLengthDict = {'Jan': 31, 'Feb': 28, 'Mar': 31, 'Apr': 30, 'May': 31, 'Jun': 30, 'Jul': 31,
-                           'Aug': 31, 'Sep': 30, 'Oct': 31, 'Nov': 30, 'Dec': 31,
-                           1: 31, 2: 29, 3: 31, 4: 30, 5: 31, 6: 30, 7: 31,
-                           8: 31, 9: 30, 10: 31, 11: 30, 12: 31}
-        monthLength = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    return (monthLengthDict, monthLength)
+    return _MONTHS[calendar.isleap(testDate.year)]
 
 
-def QBEdit(url, ticket, dbid, rid, field, value):
+def QBEdit(url, ticket, dbid, rid, field, value, session=None):
     """
     DEPRECATED
     :param url:
@@ -970,30 +1165,24 @@ def QBEdit(url, ticket, dbid, rid, field, value):
     :param rid:
     :param field:
     :param value:
-    :return:
+    :param session: optional requests.Session to send the request on instead of the shared one
+    :return: the response body as bytes. This used to be the urlopen response object, so call sites that did
+    response.read() should use the return value directly
     """
     action = 'API_EditRecord'
 
-    query = urllib.request.Request(url + dbid)
-    query.add_header("Content-Type", "application/xml")
-    query.add_header("QUICKBASE-ACTION", action)
-    data = """
-        <qdbapi>
-            <msInUTC>%s</msInUTC>
-            <ticket>%s</ticket>
-            <rid>%s</rid>
-            <field fid="%s">%s</field>
-        </qdbapi>
-    """ % ('0', ticket, rid, field, value)
-    query.data = data.encode('utf-8')
-    response = urllib.request.urlopen(query, timeout=DEFAULT_TIMEOUT)
+    data = b''.join((_XML_HEADER % _toBytes(ticket),
+                     _XML_RID % _toBytes(rid),
+                     _buildFieldsBody({field: value}),
+                     _XML_FOOTER))
+    response = _postXML(url + dbid, data, action, session=session)
 
     # Analytics().collect(tags={'action': action})
 
-    return response
+    return response.content
 
 
-def UploadCsv(url, ticket, dbid, csvData, clist, skipFirst=0):
+def UploadCsv(url, ticket, dbid, csvData, clist, skipFirst=0, session=None):
     """
     DEPRECATED
     Given a csv-formatted string, list, or dict, upload records to Quickbase
@@ -1007,88 +1196,45 @@ def UploadCsv(url, ticket, dbid, csvData, clist, skipFirst=0):
     :param clist: string of period-separated field IDs mapping the CSV data to fields in Quickbase
     :param skipFirst: If 1, the first line is skipped (useful if uploading a csv which contains labels). Will always be
     0 when uploading a dict, because dicts are unordered.
+    :param session: optional requests.Session to send the request on instead of the shared one
     :return: response contains troubleshooting information including error code and value, count of records added,
     and count of records edited.
     """
     action = 'API_ImportFromCSV'
 
-    request = urllib.request.Request(url + dbid)
-    request.add_header("Content-Type", "application/xml")
-    request.add_header("QUICKBASE-ACTION", action)
-    if type(csvData) == str:
-        data = """
-        <qdbapi>
-            <msInUTC>%s</msInUTC>
-            <ticket>%s</ticket>
-            <records_csv>
-                <![CDATA[
-                    %s
-                ]]>
-            </records_csv>
-            <clist>%s</clist>
-            <skipfirst>%s</skipfirst>
-        </qdbapi>
-            """ % ('0', ticket, csvData, clist, skipFirst)
-    elif type(csvData) == list:
-        csv_lines = ""
-        if type(csvData[0]) == list:
-            for line in csvData:
-                for item in line:
-                    assert type(item) == str
-                    csv_lines += item + ","
-                csv_lines = csv_lines[:-1] + "\n"
-        elif type(csvData[0]) == str:
-            for item in csvData:
-                assert item == str
-                csv_lines += item + ","
-            csv_lines = csv_lines[:-1] + "\n"
-        data = """
-        <qdbapi>
-            <msInUTC>%s</msInUTC>
-            <ticket>%s</ticket>
-            <records_csv>
-                <![CDATA[
-                    %s
-                ]]>
-            </records_csv>
-            <clist>%s</clist>
-            <skipfirst>%s</skipfirst>
-        </qdbapi>
-            """ % ('0', ticket, csv_lines, clist, skipFirst)
-    elif type(csvData) == dict:
-        csv_lines = ""
-        for record_id in csvData:
-            assert type(record_id) == str and type(csvData[record_id]) == list
-            line = csvData[record_id]
-            csv_lines += record_id + ','
-            for item in line:
-                assert type(item) == str
-                csv_lines += item + ","
-            csv_lines = csv_lines[:-1] + "\n"
-        data = """
-        <qdbapi>
-            <msInUTC>%s</msInUTC>
-            <ticket>%s</ticket>
-            <records_csv>
-                <![CDATA[
-                    %s
-                ]]>
-            </records_csv>
-            <clist>%s</clist>
-            <skipfirst>%s</skipfirst>
-        </qdbapi>
-            """ % ('0', ticket, csv_lines, clist, "0")
-    else:
+    csv_lines = _csvText(csvData)
+    if csv_lines is None:
         return None
-    request.data = data.encode('utf-8')
-    response = urllib.request.urlopen(request, timeout=DEFAULT_TIMEOUT).read()
+    skip_first = "0" if isinstance(csvData, dict) else skipFirst  # a dict has no label line to skip
+    data = b''.join((_XML_HEADER % _toBytes(ticket),
+                     _buildCsvBody(csv_lines, clist, skip_first),
+                     _XML_FOOTER))
+    response = _postXML(url + dbid, data, action, session=session).content
 
     # Analytics().collect(tags={'action': action})
 
     return response
 
 
-def DownloadCSV(base_url, ticket, dbid, report_id, file_name="report.csv"):
+def _downloadToFile(url, file_name, session=None, timeout=DEFAULT_TIMEOUT):
+    """Streams a GET response to disk in DOWNLOAD_CHUNK_SIZE pieces, reusing a pooled connection. The download is
+    written to a .part file next to file_name and only moved into place once it is complete, so an error response
+    or a dropped connection leaves any existing file untouched"""
+    with (session or _SESSION).get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        part_name = '%s.%s.part' % (file_name, uuid.uuid4().hex)    # same directory, so os.replace is atomic
+        try:
+            with open(part_name, 'wb') as downloaded_file:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):    # write to disk as it arrives
+                    downloaded_file.write(chunk)
+            os.replace(part_name, file_name)
+        except BaseException:
+            if os.path.exists(part_name):
+                os.remove(part_name)
+            raise
+
+
+def DownloadCSV(base_url, ticket, dbid, report_id, file_name="report.csv", session=None, timeout=None):
     """
     DEPRECATED
     :param base_url:
@@ -1096,11 +1242,13 @@ def DownloadCSV(base_url, ticket, dbid, report_id, file_name="report.csv"):
     :param dbid:
     :param report_id:
     :param file_name:
+    :param session: optional requests.Session to download with instead of the shared one
+    :param timeout: seconds to wait for the server, which includes the time Quickbase takes to generate the report.
+    Defaults to None, which waits indefinitely
     :return:
     """
-    csv_file = file_name
-    urllib.request.urlretrieve(base_url + dbid + "?a=q&qid=" + str(report_id) + "&dlta=xs%7E&ticket=" + ticket,
-                               csv_file)
+    url = base_url + dbid + "?a=q&qid=" + str(report_id) + "&dlta=xs%7E&ticket=" + ticket
+    _downloadToFile(url, file_name, session, timeout)
 
     # Analytics().collect(tags={'action': 'download_csv'})
 
@@ -1124,41 +1272,124 @@ def csvSort(input_file,
         delimiter = ","
     if quotechar is None:
         quotechar = '"'
+    if pandas is not None and os.path.getsize(input_file) > CSV_SORT_PANDAS_THRESHOLD and \
+            _csvSortPandas(input_file, output_file, sort_keys, contains_labels, format, quotechar, delimiter):
+        return
     with open(input_file, 'r', newline='', encoding=format) as csv_input_file:
         r = csv.reader(csv_input_file, quotechar=quotechar, delimiter=delimiter)
-        unsorted_lines = []
-        first_line = True
-        for line in r:
-            if first_line and contains_labels:
-                file_labels = line
-                first_line = False
-            else:
-                try:
-                    unsorted_lines.append(line)
-                except UnicodeDecodeError as err:
-                    print(err)
-                    print(line)
-                    print(r)
-        sorted_lines = unsorted_lines
-        sort_keys.reverse()
+        file_labels = next(r, None) if contains_labels else None
+        sorted_lines = list(r)
+        key_columns = []    # (column index, coercion) pairs, from highest to lowest sort level
         for sort_key in sort_keys:
             try:
-                int(sorted_lines[0][sort_key])
-                sorted_lines = sorted(sorted_lines, key=lambda item: int(item[sort_key]))
-            except ValueError:
-                sorted_lines = sorted(sorted_lines, key=lambda item: item[sort_key].lower())
-            except IndexError:
+                key_columns.append((sort_key, _csvColumnCoercion(sorted_lines, sort_key)))
+            except IndexError:  # a row is too short to have this column, so it is not sorted on
                 print(sorted_lines[0])
                 print(sort_key)
                 print(len(sorted_lines[0]))
+        order = _numericSortOrder(sorted_lines, key_columns)
+        if order is not None:   # rows are written in this order, without building a second list
+            sorted_lines = map(sorted_lines.__getitem__, order)
+        else:
+            # a single stable sort on a compound key gives the same order as one pass per key
+            sorted_lines.sort(key=_csvSortKey(key_columns))
     with open(output_file, 'w', newline='', encoding='utf-8') as csv_output_file:
         w = csv.writer(csv_output_file, quotechar=quotechar, delimiter=delimiter)
         if file_labels:
             w.writerow(file_labels)
-        for line in sorted_lines:
-            w.writerow(line)
+        w.writerows(sorted_lines)
+
+def _csvColumnCoercion(lines, sort_key):
+    """How csvSort compares the values in one column: int if every value in the column parses as an int, otherwise
+    case-insensitive text, so a blank cell in a numeric column sorts the column as text rather than failing. Raises
+    IndexError if a row has no such column"""
+    column = list(map(operator.itemgetter(sort_key), lines))
+    try:
+        for value in column:
+            int(value)
+    except ValueError:
+        return str.lower
+    return int
+
+
+def _csvSortKey(key_columns):
+    """Sort key for csvSort's list sort. The key is computed once per row; itemgetter pulls the columns out in C, and
+    when every column is coerced the same way map applies it without a Python-level loop"""
+    if not key_columns:
+        return lambda item: ()
+    getter = operator.itemgetter(*(sort_key for sort_key, coerce in key_columns))
+    coercions = {coerce for sort_key, coerce in key_columns}
+    if len(key_columns) == 1:
+        coerce = key_columns[0][1]
+        return lambda item: coerce(getter(item))
+    if len(coercions) == 1:
+        coerce = coercions.pop()
+        return lambda item: tuple(map(coerce, getter(item)))
+    return lambda item: tuple(coerce(item[sort_key]) for sort_key, coerce in key_columns)
+
+
+def _numericSortOrder(lines, key_columns):
+    """Row order for csvSort when every sort column is numeric, using a stable numpy lexsort on int64 columns instead of
+    comparing Python tuples. Returns None if numpy is not installed, a column is not numeric, a row is too short, or a
+    value does not fit in an int64. csvSort then sorts the lists with the same coercions, which _csvColumnCoercion has
+    already checked against every row, so that sort cannot fail the same way"""
+    if numpy is None or not key_columns or any(coerce is not int for sort_key, coerce in key_columns):
+        return None
+    try:
+        # lexsort treats its last key as the primary one, so the columns are given from lowest to highest sort level
+        # numpy parses each column of strings to int64 in C, rather than calling int() on every value
+        columns = [numpy.array(list(map(operator.itemgetter(sort_key), lines)), dtype=numpy.int64)
+                   for sort_key, coerce in reversed(key_columns)]
+    except (ValueError, OverflowError, IndexError):
+        return None
+    return numpy.lexsort(columns)
+
+
+def _pandasSortKey(column):
+    """Sort key for one column in _csvSortPandas, matching the int or case-insensitive ordering used by csvSort"""
+    try:
+        int(column.iloc[0])
+        return column.astype('int64')
+    except (ValueError, IndexError):
+        return column.str.lower()
+
+
+def _csvSortPandas(input_file, output_file, sort_keys, contains_labels, format, quotechar, delimiter):
+    """csvSort for large files. The rows are read into a DataFrame and sorted with numpy rather than as Python lists
+
+    pandas pads short rows, turns blank lines into empty fields and rewrites labels, so it is only used when its output
+    is byte-identical to the list path: every line must be one complete row with the same number of fields, which can
+    only be checked cheaply when the file contains no quote characters. The labels are copied with the csv module.
+    Returns False, without writing anything, if the file has to be sorted by the list path instead
+    """
+    with open(input_file, 'rb') as csv_input_file:
+        content = csv_input_file.read()
+    if quotechar.encode(format) in content:
+        return False
+    lines = content.splitlines()
+    field_counts = set(map(operator.methodcaller('count', delimiter.encode(format)), lines))
+    if len(field_counts) != 1 or not all(lines):    # ragged rows or blank lines
+        return False
+    file_labels = None
+    if contains_labels:
+        file_labels = next(csv.reader([lines[0].decode(format)], quotechar=quotechar, delimiter=delimiter))
+    try:
+        frame = pandas.read_csv(io.BytesIO(content), header=None, skiprows=1 if contains_labels else 0, dtype=str,
+                                na_filter=False, skip_blank_lines=False, encoding=format, quotechar=quotechar,
+                                sep=delimiter)
+        frame.sort_values(by=[frame.columns[sort_key] for sort_key in sort_keys], key=_pandasSortKey,
+                          kind='stable', inplace=True)
+    except (pandas.errors.ParserError, pandas.errors.EmptyDataError, ValueError, OverflowError, IndexError):
+        return False
+    with open(output_file, 'w', newline='', encoding='utf-8') as csv_output_file:
+        if file_labels:
+            csv.writer(csv_output_file, quotechar=quotechar, delimiter=delimiter).writerow(file_labels)
+        frame.to_csv(csv_output_file, header=False, index=False, quotechar=quotechar, sep=delimiter,
+                     lineterminator='\r\n')
+    return True
+
 
-def downloadFile(dbid, ticket, rid, fid, filename, vid='0', baseurl=''):
+def downloadFile(dbid, ticket, rid, fid, filename, vid='0', baseurl='', session=None):
     """
     DEPRECATED
     :param dbid:
@@ -1168,14 +1399,12 @@ def downloadFile(dbid, ticket, rid, fid, filename, vid='0', baseurl=''):
     :param filename:
     :param vid:
     :param baseurl:
+    :param session: optional requests.Session to download with instead of the shared one
     :return:
     """
 
-    request = urllib.request.Request(
-        baseurl + 'up/' + dbid + '/a/r' + rid + '/e' + fid + '/v' + vid + '?ticket=' + ticket)
-    response = urllib.request.urlopen(request, timeout=DEFAULT_TIMEOUT).read()
-    with open(filename, 'wb') as downloaded_file:
-        downloaded_file.write(response)
+    url = baseurl + 'up/' + dbid + '/a/r' + rid + '/e' + fid + '/v' + vid + '?ticket=' + ticket
+    _downloadToFile(url, filename, session)
 
     # Analytics().collect(tags={'action': 'download_file'})
 
@@ -1195,19 +1424,16 @@ def recursive_query(query_object):
         query_object.record_return = int(query_object.record_return / 2)
         query_object.error_75_retry = False
         query_object = recursive_query(query_object)
-    options = str()
-    if query_object.options is not None:
-        existing_options = query_object.options.split('.')
-        for option in existing_options:
-            if 'num-' not in option and 'skp-' not in option:
-                options += '.' + option
-    options += '.num-' + str(query_object.record_return)
+    options = list()
+    if query_object.options is not None:    # keep any options other than the paging ones set here
+        options.extend(option for option in query_object.options.split('.')
+                       if option and 'num-' not in option and 'skp-' not in option)
+    options.append('num-' + str(query_object.record_return))
     if query_object.response is not None:
         if len(query_object.response.values) >= int(query_object.record_count):
             return query_object
-        options += '.skp-' + str(len(query_object.response.values))
-    if options[0] == '.':
-        options = options[1:]
+        options.append('skp-' + str(len(query_object.response.values)))
+    options = '.'.join(options)
     fractional_query = QuickbaseAction(query_object.app,
                                        query_object.dbid_key,
                                        'query',
@@ -9,4 +9,5 @@ setup(name='quickbase',
       author='Mike Herman',
       author_email='mgherm@gmail.com',
       packages=['quickbase'],
+      install_requires=['pytz', 'requests'],
       zip_safe=False)
\ No newline at end of file